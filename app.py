@@ -15,10 +15,10 @@ from dataclasses import dataclass
 from pathlib import Path
 from typing import Callable, Dict, List, Optional
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from werkzeug.utils import secure_filename
 import os
 import io
-import re
 import tempfile
 import threading
 import time
@@ -40,11 +40,16 @@ app = Flask(__name__)
 # 1スライドあたりの最大文字数
 MAX_CHARS_PER_SLIDE = 150
 
+# 話者マーカー《名前》（行頭のみ判定）
+SPEAKER_OPEN = "《"
+SPEAKER_CLOSE = "》"
+
 # テキスト領域設定（右下枠と被らない範囲）
 TEXT_LEFT_CM = 0.79
 TEXT_TOP_CM = 0.80
 TEXT_WIDTH_CM = 25.2   # 枠にかからない右端まで
 TEXT_HEIGHT_CM = 15.6
+TEXT_FONT_SIZE_PT = 40
 
 # 右下の枠設定（位置・サイズ）
 FRAME_LEFT_CM = 25.87
@@ -59,6 +64,18 @@ PAGE_COLOR = RGBColor(0x00, 0x9D, 0xFF)  # #009DFF
 PAGE_FONT_SIZE_PT = 32
 PAGE_FONT_BOLD = True
 
+# 上記をEMUに換算した値（スライドごとの単位変換を省くため一度だけ計算）
+TEXT_BOX_EMU = (Cm(TEXT_LEFT_CM), Cm(TEXT_TOP_CM), Cm(TEXT_WIDTH_CM), Cm(TEXT_HEIGHT_CM))
+TEXT_FONT_SIZE = Pt(TEXT_FONT_SIZE_PT)
+FRAME_BOX_EMU = (Cm(FRAME_LEFT_CM), Cm(FRAME_TOP_CM), Cm(FRAME_WIDTH_CM), Cm(FRAME_HEIGHT_CM))
+FRAME_FILL_COLOR = RGBColor(0xF0, 0xF0, 0xF0)
+FRAME_LINE_COLOR = RGBColor(0x64, 0x64, 0x64)
+FRAME_LINE_WIDTH = Pt(2)
+PAGE_BOX_EMU = (Cm(PAGE_LEFT_CM), Cm(PAGE_TOP_CM), Cm(4), Cm(1.5))
+PAGE_FONT_SIZE = Pt(PAGE_FONT_SIZE_PT)
+BACKGROUND_COLOR = RGBColor(0, 0, 0)
+ZERO_SPACING = Pt(0)
+
 # Web API settings
 UPLOAD_FOLDER = Path(tempfile.gettempdir()) / "split_pptx_uploads"
 UPLOAD_FOLDER.mkdir(parents=True, exist_ok=True)
@@ -83,7 +100,9 @@ conversion_queue: deque[ConversionJob] = deque()
 queue_lock = threading.Lock()
 queue_event = threading.Event()
 worker_thread: Optional[threading.Thread] = None
+cleanup_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cleanup")
 last_cleanup = time.time()
+current_process = None  # psutil.Process handle, created on first memory probe
 
 # 明示的な話者ごとの色（固定）
 NAME_FIXED_COLORS = {
@@ -92,6 +111,9 @@ NAME_FIXED_COLORS = {
     "星野": RGBColor(0xFF, 0xFF, 0x00),  # #FFFF00（黄色）
 }
 
+# 話者名なしのテキスト色
+DEFAULT_NAME_COLOR = RGBColor(0xFF, 0xFF, 0xFF)  # デフォルト白
+
 # 明示指定以外の話者に自動割り当て（以降固定）
 AUTO_COLOR_POOL = [
     RGBColor(0xFF, 0x40, 0xFF),  # ピンク
@@ -133,7 +155,7 @@ def _enqueue_job(job: ConversionJob) -> int:
         conversion_queue.append(job)
         _update_queue_positions_locked()
         queue_event.set()
-        return conversion_queue.index(job)
+        return len(conversion_queue) - 1
 
 
 def _dequeue_job() -> Optional[ConversionJob]:
@@ -149,17 +171,15 @@ def _dequeue_job() -> Optional[ConversionJob]:
 
 
 def _get_memory_usage_mb() -> float:
+    global current_process
     if psutil is None:
         return 0.0
     try:
-        process = psutil.Process()
-        rss = process.memory_info().rss
-        for child in process.children(recursive=True):
-            try:
-                rss += child.memory_info().rss
-            except (psutil.NoSuchProcess, psutil.AccessDenied):
-                continue
-        return rss / 1024 / 1024
+        if current_process is None:
+            current_process = psutil.Process()
+        # The app spawns no subprocesses, so our own RSS is the whole footprint;
+        # walking children would scan every entry in /proc for nothing.
+        return current_process.memory_info().rss / 1024 / 1024
     except Exception:
         return 0.0
 
@@ -171,19 +191,22 @@ def _force_gc() -> None:
         pass
 
 
+def _remove_dir_async(path: Path) -> None:
+    # Deletion runs on the cleanup thread so the worker and requests never wait on disk I/O.
+    try:
+        cleanup_executor.submit(shutil.rmtree, path, ignore_errors=True)
+    except RuntimeError:
+        # Executor already shut down (interpreter exit) - fall back to inline removal.
+        shutil.rmtree(path, ignore_errors=True)
+
+
 def _cleanup_task_files(task_id: str) -> None:
     status = task_status.pop(task_id, None)
     if not status:
         return
     file_path_value = status.get("file_path")
     if file_path_value:
-        try:
-            path = Path(file_path_value)
-            if path.exists():
-                path.unlink()
-            shutil.rmtree(path.parent, ignore_errors=True)
-        except Exception:
-            pass
+        _remove_dir_async(Path(file_path_value).parent)
     _force_gc()
 
 
@@ -214,21 +237,24 @@ def get_color_for_name(name: str):
     """話者ごとに色を固定して返す"""
     global _auto_color_idx
     if not name:
-        return RGBColor(0xFF, 0xFF, 0xFF)  # デフォルト白
+        return DEFAULT_NAME_COLOR
 
     # 明示指定があればそれを使う
     if name in NAME_FIXED_COLORS:
         return NAME_FIXED_COLORS[name]
 
     # 既存登録があればそれを再利用
-    if name in name_color_map:
-        return name_color_map[name]
+    cached = name_color_map.get(name)
+    if cached is not None:
+        return cached
 
     # 新規話者 → 自動カラー割り当て
+    # 複数スレッドから同時に来た場合は先に登録された色を採用（重複計算は無害）
     color = AUTO_COLOR_POOL[_auto_color_idx % len(AUTO_COLOR_POOL)]
-    name_color_map[name] = color
-    _auto_color_idx += 1
-    return color
+    assigned = name_color_map.setdefault(name, color)
+    if assigned is color:
+        _auto_color_idx += 1
+    return assigned
 
 
 def clean_text(text: str) -> str:
@@ -250,16 +276,17 @@ def parse_notes_into_segments(note_text: str):
         if not line:
             continue
 
-        match = re.match(r"《(.+?)》", line)
-        if match:
+        # 行頭の《名前》を正規表現なしで判定（名前は1文字以上、最初の》まで）
+        close = line.find(SPEAKER_CLOSE, 2) if line.startswith(SPEAKER_OPEN) else -1
+        if close != -1:
             # 直前バッファを保存
             if buffer:
                 joined = "".join(buffer).strip()
                 if joined:
                     segments.append((current_name, joined))
                 buffer = []
-            current_name = match.group(1)
-            rest = line[match.end():]
+            current_name = line[1:close]
+            rest = line[close + 1:]
             if rest:
                 buffer.append(rest)
         else:
@@ -270,14 +297,16 @@ def parse_notes_into_segments(note_text: str):
         if joined:
             segments.append((current_name, joined))
 
-    # 連続する同名を結合
-    merged = []
+    # 連続する同名を結合（話者名と本文断片を別配列で持ち、最後に一度だけ連結）
+    merged_names = []
+    merged_parts = []
     for name, text in segments:
-        if merged and merged[-1][0] == name:
-            merged[-1] = (name, merged[-1][1] + text)
+        if merged_names and merged_names[-1] == name:
+            merged_parts[-1].append(text)
         else:
-            merged.append((name, text))
-    return merged
+            merged_names.append(name)
+            merged_parts.append([text])
+    return [(name, "".join(parts)) for name, parts in zip(merged_names, merged_parts)]
 
 
 def pack_segments_into_chunks(segments, max_len=MAX_CHARS_PER_SLIDE):
@@ -289,42 +318,31 @@ def pack_segments_into_chunks(segments, max_len=MAX_CHARS_PER_SLIDE):
     cur = []
     cur_len = 0
 
-    def flush():
-        nonlocal cur, cur_len
-        if cur:
-            chunks.append(cur)
-            cur = []
-            cur_len = 0
-
+    # 文字数は各セグメントで一度だけ数え、切り出し量から累計する
     for name, text in segments:
+        text_len = len(text)
         i = 0
-        while i < len(text):
-            remain = max_len - cur_len
-            if remain <= 0:
-                flush()
-                remain = max_len
-            take = min(remain, len(text) - i)
-            part = text[i:i + take]
-            cur.append((name, part))
-            cur_len += len(part)
+        while i < text_len:
+            if cur_len >= max_len:
+                chunks.append(cur)
+                cur = []
+                cur_len = 0
+            take = min(max_len - cur_len, text_len - i)
+            cur.append((name, text[i:i + take]))
+            cur_len += take
             i += take
-    flush()
+    if cur:
+        chunks.append(cur)
     return chunks
 
 
 def add_photo_frame(slide):
     """右下に固定枠を追加"""
-    shape = slide.shapes.add_shape(
-        MSO_SHAPE.RECTANGLE,
-        Cm(FRAME_LEFT_CM),
-        Cm(FRAME_TOP_CM),
-        Cm(FRAME_WIDTH_CM),
-        Cm(FRAME_HEIGHT_CM)
-    )
+    shape = slide.shapes.add_shape(MSO_SHAPE.RECTANGLE, *FRAME_BOX_EMU)
     shape.fill.solid()
-    shape.fill.fore_color.rgb = RGBColor(0xF0, 0xF0, 0xF0)
-    shape.line.color.rgb = RGBColor(0x64, 0x64, 0x64)
-    shape.line.width = Pt(2)
+    shape.fill.fore_color.rgb = FRAME_FILL_COLOR
+    shape.line.color.rgb = FRAME_LINE_COLOR
+    shape.line.width = FRAME_LINE_WIDTH
     return shape
 
 
@@ -332,7 +350,7 @@ def add_page_indicator(slide, index, total):
     """分割時のみページ番号を表示"""
     if total <= 1:
         return
-    tb = slide.shapes.add_textbox(Cm(PAGE_LEFT_CM), Cm(PAGE_TOP_CM), Cm(4), Cm(1.5))
+    tb = slide.shapes.add_textbox(*PAGE_BOX_EMU)
     tf = tb.text_frame
     tf.clear()
     p = tf.paragraphs[0]
@@ -340,7 +358,7 @@ def add_page_indicator(slide, index, total):
     p.alignment = PP_ALIGN.LEFT
     font = p.font
     font.name = "メイリオ"
-    font.size = Pt(PAGE_FONT_SIZE_PT)
+    font.size = PAGE_FONT_SIZE
     font.bold = PAGE_FONT_BOLD
     font.color.rgb = PAGE_COLOR
 
@@ -353,33 +371,36 @@ def create_script_slides(notes):
     prs = Presentation()
     prs.slide_width = Cm(33.867)
     prs.slide_height = Cm(19.05)
+    blank_layout = prs.slide_layouts[6]
+    slides = prs.slides
+
+    # 同一本文のノートは解析結果を使い回す（キャッシュはこのデッキ内に限定）
+    chunks_by_note = {}
 
     for note in notes:
-        segments = parse_notes_into_segments(note)
-        chunks = pack_segments_into_chunks(segments, MAX_CHARS_PER_SLIDE)
+        chunks = chunks_by_note.get(note)
+        if chunks is None:
+            segments = parse_notes_into_segments(note)
+            chunks = pack_segments_into_chunks(segments, MAX_CHARS_PER_SLIDE)
+            chunks_by_note[note] = chunks
         total_parts = len(chunks)
 
         for idx, chunk in enumerate(chunks, start=1):
-            slide = prs.slides.add_slide(prs.slide_layouts[6])
+            slide = slides.add_slide(blank_layout)
 
             # 背景を黒に
             fill = slide.background.fill
             fill.solid()
-            fill.fore_color.rgb = RGBColor(0, 0, 0)
+            fill.fore_color.rgb = BACKGROUND_COLOR
 
             # テキストボックス
-            txBox = slide.shapes.add_textbox(
-                Cm(TEXT_LEFT_CM),
-                Cm(TEXT_TOP_CM),
-                Cm(TEXT_WIDTH_CM),
-                Cm(TEXT_HEIGHT_CM)
-            )
+            txBox = slide.shapes.add_textbox(*TEXT_BOX_EMU)
             tf = txBox.text_frame
             tf.clear()
             tf.word_wrap = True
             p = tf.paragraphs[0]
-            p.space_before = Pt(0)
-            p.space_after = Pt(0)
+            p.space_before = ZERO_SPACING
+            p.space_after = ZERO_SPACING
 
             # 各話者テキストをrun単位で追加
             for name, part in chunk:
@@ -388,7 +409,7 @@ def create_script_slides(notes):
                 run.text = prefix + part
                 f = run.font
                 f.name = "メイリオ"
-                f.size = Pt(40)
+                f.size = TEXT_FONT_SIZE
                 f.bold = True
                 f.color.rgb = get_color_for_name(name)
 
@@ -403,7 +424,7 @@ def create_script_slides(notes):
 
 def generate_script_slides(
     input_path: Path,
-    temp_dir: Path,
+    output_dir: Path,
     log_callback: Optional[Callable[[str], None]] = None,
 ) -> Path:
     def log(message: str) -> None:
@@ -415,9 +436,11 @@ def generate_script_slides(
 
     notes: List[str] = []
     for slide in prs.slides:
-        if slide.has_notes_slide and slide.notes_slide.notes_text_frame:
-            text = slide.notes_slide.notes_text_frame.text
-            cleaned = clean_text(text)
+        if not slide.has_notes_slide:
+            continue
+        notes_frame = slide.notes_slide.notes_text_frame
+        if notes_frame:
+            cleaned = clean_text(notes_frame.text)
             if cleaned:
                 notes.append(cleaned)
 
@@ -426,7 +449,7 @@ def generate_script_slides(
 
     log("スクリプトスライドを生成しています...")
     new_prs = create_script_slides(notes)
-    output_path = temp_dir / "スクリプトスライド_自動生成.pptx"
+    output_path = output_dir / "スクリプトスライド_自動生成.pptx"
     new_prs.save(output_path)
     log("スクリプトスライドの生成が完了しました。")
     return output_path
@@ -436,7 +459,7 @@ def _process_conversion_job(job: ConversionJob) -> None:
     task_id = job.task_id
     status = task_status.get(task_id)
     if status is None:
-        shutil.rmtree(job.temp_dir, ignore_errors=True)
+        _remove_dir_async(job.temp_dir)
         return
 
     status.update(
@@ -449,12 +472,17 @@ def _process_conversion_job(job: ConversionJob) -> None:
     _add_log(task_id, "変換を開始しました。")
 
     try:
-        result_path = generate_script_slides(job.input_path, job.temp_dir, job.log_callback)
-
+        # 一時ディレクトリを経由せず出力先へ直接保存する
         job.output_dir.mkdir(parents=True, exist_ok=True)
+        result_path = generate_script_slides(job.input_path, job.output_dir, job.log_callback)
+
         final_path = job.output_dir / job.output_filename
         if result_path != final_path:
-            shutil.copy2(result_path, final_path)
+            # 同一ファイルシステムならリネームのみ（コピー不要）
+            try:
+                os.replace(result_path, final_path)
+            except OSError:
+                shutil.move(str(result_path), str(final_path))
 
         status.update(
             {
@@ -475,10 +503,11 @@ def _process_conversion_job(job: ConversionJob) -> None:
                 "queue_position": None,
             }
         )
+        _remove_dir_async(job.output_dir)
         _add_log(task_id, f"変換に失敗しました: {exc}")
     finally:
         try:
-            shutil.rmtree(job.temp_dir, ignore_errors=True)
+            _remove_dir_async(job.temp_dir)
         finally:
             _force_gc()
 
@@ -500,13 +529,18 @@ def _ensure_worker_started() -> None:
         worker_thread.start()
 
 
-def _serialize_status(task_id: str, status: Dict[str, object]) -> Dict[str, object]:
+def _serialize_status(
+    task_id: str, status: Dict[str, object], log_offset: int = 0
+) -> Dict[str, object]:
+    logs: List[str] = status.get("logs", [])  # type: ignore[assignment]
     response = {
         "task_id": task_id,
         "status": status.get("status", "unknown"),
         "message": status.get("message", ""),
         "download_url": status.get("download_url"),
-        "logs": status.get("logs", []),
+        # Only lines the client has not seen yet; log_count is the next offset to request.
+        "logs": logs[log_offset:],
+        "log_count": len(logs),
         "queue_position": status.get("queue_position"),
     }
     return response
@@ -636,7 +670,8 @@ def get_status(task_id: str):
     status = task_status.get(task_id)
     if status is None:
         return jsonify({"detail": "Task not found"}), 404
-    return jsonify(_serialize_status(task_id, status))
+    log_offset = max(request.args.get("since", default=0, type=int), 0)
+    return jsonify(_serialize_status(task_id, status, log_offset))
 
 
 @app.route("/download/<task_id>", methods=["GET"])